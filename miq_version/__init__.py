@@ -1,28 +1,53 @@
 import re
-from datetime import date, datetime
+import string
+import sys
+from datetime import date
+from email.utils import parsedate_to_datetime
 
 import attr
 import requests
-from cached_property import cached_property
-from functools import total_ordering
-from lxml import html
+from functools import lru_cache
 
 from . import constants
 
 
-@total_ordering
+class cached_property(object):
+    """Compute the value once and store it in the instance ``__dict__``
+
+    Later lookups find the stored value before the descriptor, so reading it is a plain
+    attribute access without any locking.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.name = func.__name__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name] = self.func(obj)
+        return value
+
+
 class Version(object):
     """Version class based on distutil.version.LooseVersion"""
+    __slots__ = ('vstring', 'version', 'suffix', 'normalized_suffix', '_hash', '_spt',
+                 '_is_latest', '_is_lowest', '_key', '__weakref__')
     SUFFIXES = ('nightly', 'pre', 'alpha', 'beta', 'rc')
-    SUFFIXES_STR = "|".join(rf'-{suffix}(?:\d+(?:\.\d+)?)?' for suffix in SUFFIXES)
-    component_re = re.compile(rf'(?:\s*(\d+|[a-z]+|\.|(?:{SUFFIXES_STR})+$))')
-    suffix_item_re = re.compile(r'^([^0-9]+)(\d+(?:\.\d+)?)?$')
+    _SUFFIX_SET = frozenset(SUFFIXES)
+    SUFFIX_IDX = {suffix: i for i, suffix in enumerate(SUFFIXES)}
+    _MASTER_ALIASES = frozenset(('master', 'latest', 'upstream'))
 
     def __init__(self, vstring):
         self.parse(vstring)
 
     def __hash__(self):
-        return hash(self.vstring)
+        return self._hash
+
+    def __reduce__(self):
+        # copies and unpickled versions parse the string again, the derived state holds a
+        # per-process string hash and the series SPTuple
+        return type(self), (self.vstring,)
 
     def parse(self, vstring):
         if vstring is None:
@@ -32,50 +57,87 @@ class Version(object):
         elif vstring:
             vstring = str(vstring).strip()
         # TODO separate upstream versions
-        if vstring in ('master', 'latest', 'upstream'):
+        if vstring in self._MASTER_ALIASES:
             vstring = 'master'
-        for upstream_series in constants.SORTED_UPSTREAM_RELEASES:
-            if upstream_series in vstring:
-                vstring = upstream_series
-
-        components = list(filter(lambda x: x and x != '.',
-                            self.component_re.findall(vstring)))
-        # Check if we have a version suffix which denotes pre-release
-        if components and components[-1].startswith('-'):
-            self.suffix = components[-1][1:].split('-')    # Chop off the -
-            components = components[:-1]
-        else:
-            self.suffix = None
-        for i in range(len(components)):
-            try:
-                components[i] = int(components[i])
-            except ValueError:
-                pass
+        upstream_series = constants.UPSTREAM_SERIES_RE.findall(vstring)
+        if upstream_series:
+            # the newest release wins when the string names several
+            vstring = min(upstream_series, key=constants.SORTED_UPSTREAM_RELEASES.index)
+
+        self.version, self.suffix, self.normalized_suffix = self._parse_str(vstring)
+        # many Versions share a few version strings, intern them so equal strings are shared
+        self.vstring = vstring = sys.intern(vstring)
+        self._hash = hash(vstring)
+        # equal to latest() and lowest(), checked on every ordering comparison
+        self._is_latest = self.version == ('master',) and not self.normalized_suffix
+        self._is_lowest = self.version == ('lowest',) and not self.normalized_suffix
+        self._key = self._sort_key()
+        self._spt = _find_series(self.version)  # SPTuple for stream() and product_version()
 
-        self.vstring = vstring
-        self.version = components
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _parse_str(cls, vstring):
+        """Cached :py:meth:`_tokenize` with immutable results, shared by Versions of a string"""
+        components, suffix, normalized_suffix = cls._tokenize(vstring)
+        return tuple(components), None if suffix is None else tuple(suffix), normalized_suffix
 
-    @cached_property
-    def normalized_suffix(self):
-        """Turns the string suffixes to numbers. Creates a list of tuples.
+    @classmethod
+    def _tokenize(cls, vstring):
+        """Split a version string into its components and pre-release suffix in a single pass.
 
-        The list of tuples is consisting of 2-tuples, the first value says the position of the
-        suffix in the list and the second number the numeric value of an eventual numeric suffix.
+        Digit runs become ints and lowercase letter runs are kept as strings. A trailing chain of
+        ``-<suffix>`` items (see :py:attr:`SUFFIXES`) denotes a pre-release and is returned as
+        the list of suffix items, or None if there is none. Any other character is skipped.
 
-        If the numeric suffix is not present in a field, then the value is 0
+        The suffix is also returned normalized to numbers, a tuple of 2-tuples: the position of the
+        suffix in SUFFIXES and the numeric value of an eventual numeric suffix (0 if not present).
         """
-        numberized = []
-        if self.suffix is None:
-            return numberized
-        for item in self.suffix:
-            suff_t, suff_ver = self.suffix_item_re.match(item).groups()
-            if suff_ver is None or len(suff_ver) == 0:
-                suff_ver = 0.0
+        parts = vstring.split('.')
+        if all(part and not part.strip(string.digits) for part in parts):
+            # plain dotted numeric version, the common case
+            return [int(part) for part in parts], None, ()
+        components = []
+        i, end = 0, len(vstring)
+        while i < end:
+            char = vstring[i]
+            if char in string.digits:
+                start = i
+                while i < end and vstring[i] in string.digits:
+                    i += 1
+                components.append(int(vstring[start:i]))
+            elif char in string.ascii_lowercase:
+                start = i
+                while i < end and vstring[i] in string.ascii_lowercase:
+                    i += 1
+                components.append(vstring[start:i])
             else:
-                suff_ver = float(suff_ver)
-            suff_t = self.SUFFIXES.index(suff_t)
-            numberized.append((suff_t, suff_ver))
-        return numberized
+                if char == '-':
+                    suffix = vstring[i + 1:].split('-')
+                    items = [cls._split_suffix(item) for item in suffix]
+                    if all(items):
+                        return components, suffix, tuple(items)
+                i += 1
+        return components, None, ()
+
+    @classmethod
+    def _split_suffix(cls, item):
+        """Normalize a suffix item like ``beta2.1`` to (index in SUFFIXES, number), None if it isn't
+        one. The number is an int, or a float if it has a fraction, and 0 if not present.
+        """
+        number = item.lstrip(string.ascii_lowercase)
+        name = item[:len(item) - len(number)]
+        if name not in cls._SUFFIX_SET:
+            return None
+        if not number:
+            return cls.SUFFIX_IDX[name], 0
+        whole, dot, fraction = number.partition('.')
+        if not whole or whole.strip(string.digits):
+            return None
+        if not dot:
+            return cls.SUFFIX_IDX[name], int(whole)
+        if not fraction or fraction.strip(string.digits):
+            return None
+        return cls.SUFFIX_IDX[name], float(number)
 
     @classmethod
     def latest(cls):
@@ -93,68 +155,82 @@ class Version(object):
             cls._lowest = cls('lowest')
             return cls._lowest
 
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _from_str(cls, vstring):
+        """Cached constructor for version strings, instances are shared so never mutate them"""
+        return cls(vstring)
+
+    @staticmethod
+    def _coerce(obj):
+        """Version from obj, strings go through the :py:meth:`_from_str` cache"""
+        if isinstance(obj, Version):
+            return obj
+        if isinstance(obj, str):
+            return Version._from_str(obj)
+        return Version(obj)
+
     def __str__(self):
         return self.vstring
 
     def __repr__(self):
         return f'{type(self).__name__}({repr(self.vstring)})'
 
+    def _cmp(self, other):
+        """Compare with other, -1 if this version is lower, 0 if they are equal and 1 otherwise"""
+        if other is self:
+            return 0
+        if other.__class__ is not self.__class__:
+            try:
+                other = self._coerce(other)
+            except Exception:
+                raise ValueError(f'Cannot compare Version to {type(other).__name__}')
+
+        if self._key == other._key:
+            return 0
+        return -1 if self._key < other._key else 1
+
+    def _sort_key(self):
+        """Tuple that orders and compares versions, see :py:meth:`_cmp`
+
+        - latest() is greater and lowest() is lower than any other version
+        - upstream release names compare as their downstream version, but lower than the
+          downstream version itself (hammer is lower than 5.10, but higher than 5.9.4)
+        - a version with a suffix is lower than the same version without, two suffixes compare
+          by their normalized values
+        """
+        if self._is_latest:
+            return (2,)
+        if self._is_lowest:
+            return (0,)
+        if self.vstring in constants.UPSTREAM_DOWNSTREAM_MAPPING:
+            map_version = constants.UPSTREAM_DOWNSTREAM_MAPPING[self.vstring]
+            version, upstream = tuple(int(s) for s in map_version.split('.')), 0
+        else:
+            version, upstream = self.version, 1
+        return 1, version, upstream, (0, self.normalized_suffix) if self.suffix else (1,)
+
     def __lt__(self, other):
-        try:
-            if not isinstance(other, type(self)):
-                other = Version(other)
-        except Exception:
-            raise ValueError(f'Cannot compare Version to {type(other).__name__}')
+        return self._cmp(other) < 0
 
-        if self == other:
-            return False
-        elif self == self.latest() or other == self.lowest():
-            return False
-        elif self == self.lowest() or other == self.latest():
-            return True
-        else:
-            if self.version != other.version:
-                # handle upstream version comparisons
-                # This logic might not be the most efficient, but its readable and predictable
-                # 1. Both objects are upstream release names, make direct string comparison
-                if (self.vstring in constants.SORTED_UPSTREAM_RELEASES and
-                        other.vstring in constants.SORTED_UPSTREAM_RELEASES):
-                    return self.version < other.version
-                # 2. Self is an upstream release name, convert to downstream version number
-                elif self.vstring in constants.SORTED_UPSTREAM_RELEASES:
-                    # need to compare upstream release string to downstream version
-                    map_version = constants.UPSTREAM_DOWNSTREAM_MAPPING.get(self.vstring)
-                    return [int(s) for s in map_version.split('.')] < other.version
-                # 3. Other is an upstream release name, convert to downstream version number
-                elif other.vstring in constants.SORTED_UPSTREAM_RELEASES:
-                    # need to compare upstream release string to downstream version
-                    map_version = constants.UPSTREAM_DOWNSTREAM_MAPPING.get(other.vstring)
-                    return self.version < [int(s) for s in map_version.split('.')]
-                else:
-                    # handles component list comparison and both versions upstream
-                    return self.version < other.version
-            # Use suffixes to decide
-            if self.suffix is None and other.suffix is None:
-                # No suffix, the same
-                return False
-            elif self.suffix is None:
-                # This does not have suffix but the other does so this is "newer"
-                return False
-            elif other.suffix is None:
-                # This one does have suffix and the other does not so this one is older
-                return True
-            else:
-                # Both have suffixes, so do some math
-                return self.normalized_suffix < other.normalized_suffix
+    def __le__(self, other):
+        return self._cmp(other) <= 0
+
+    def __gt__(self, other):
+        return self._cmp(other) > 0
+
+    def __ge__(self, other):
+        return self._cmp(other) >= 0
 
     def __eq__(self, other):
-        try:
-            if not isinstance(other, type(self)):
-                other = Version(other)
-            return (
-                self.version == other.version and self.normalized_suffix == other.normalized_suffix)
-        except Exception:
-            return False
+        if self is other:
+            return True
+        if other.__class__ is not self.__class__:
+            try:
+                other = self._coerce(other)
+            except Exception:
+                return False
+        return self._key == other._key
 
     def __contains__(self, ver):
         """Enables to use ``in`` expression for :py:meth:`Version.is_in_series`.
@@ -167,9 +243,10 @@ class Version(object):
                 :py:class:`str` provided, it will be converted to :py:class:`Version`.
         """
         try:
-            return Version(ver).is_in_series(self)
+            ver = self._coerce(ver)
         except Exception:
             return False
+        return ver.is_in_series(self)
 
     def is_in_series(self, series):
         """This method checks whether the version belongs to another version's series.
@@ -183,25 +260,36 @@ class Version(object):
 
         if not isinstance(series, Version):
             series = get_version(series)
-        if self in {self.lowest(), self.latest()}:
-            if series == self:
-                return True
-            else:
-                return False
-        return series.version == self.version[:len(series.version)]
+        if self._is_latest or self._is_lowest:
+            return series == self
+        length = len(series.version)
+        return len(self.version) >= length and series.version == self.version[:length]
 
     def series(self, n=2):
         return ".".join(self.vstring.split(".")[:n])
 
     def stream(self):
-        for v, spt in constants.version_stream_product_mapping.items():
-            if self.is_in_series(v):
-                return spt.stream
+        if self._spt is not None:
+            return self._spt.stream
 
     def product_version(self):
-        for v, spt in constants.version_stream_product_mapping.items():
-            if self.is_in_series(v):
-                return spt.product_version
+        if self._spt is not None:
+            return self._spt.product_version
+
+
+# series components -> SPTuple, a version belongs to the series its leading components match
+_SERIES_MAP = {Version._parse_str(series)[0]: spt
+               for series, spt in constants.version_stream_product_mapping.items()}
+_SERIES_LENGTHS = sorted({len(series) for series in _SERIES_MAP}, reverse=True)
+
+
+def _find_series(version):
+    """The :py:class:`constants.SPTuple` of the series the version components belong to, or None"""
+    for length in _SERIES_LENGTHS:
+        spt = _SERIES_MAP.get(version[:length])
+        if spt is not None:
+            return spt
+    return None
 
 
 LOWEST = Version.lowest()
@@ -216,6 +304,8 @@ def get_version(obj=None):
 
     If obj is None, the version will be retrieved from the current appliance
 
+    Versions for strings are cached and shared between callers, never call
+    :py:meth:`Version.parse` on the returned object, create a new :py:class:`Version` instead.
     """
     if isinstance(obj, Version):
         return obj
@@ -223,10 +313,10 @@ def get_version(obj=None):
         obj = str(obj)
     if obj.startswith('master'):
         return Version.latest()
-    return Version(obj)
+    return Version._from_str(obj)
 
 
-def datecheck(check_date):
+def datecheck(check_date, today=None):
     """Given a date object, return a date object that isn't from the future or distant past
 
     Some templates only have month/day values, not years. We create a date object
@@ -234,8 +324,9 @@ def datecheck(check_date):
         But they were actually HHMMmmdd, like 11221212, dec 12th 11:22 AM, not dec 12 year 1122
         Make sure the date isn't from future, but is also within the last 10 years
 
+    today is the date to check against, defaults to :py:meth:`date.today`
     """
-    today = date.today()
+    today = today or date.today()
     # long ago, or at least start of the millennium
     if check_date.year < 100:
         # 2 digit year, add millenia
@@ -243,12 +334,37 @@ def datecheck(check_date):
     elif check_date.year < 2000:
         # probably parsed wrong from an HHMMmmdd (hour-minute-month-day) timestamp, reset year
         check_date = check_date.replace(year=today.year)
-    while check_date > today:
-        # keep walking back, don't just set year, because month/day might be later in the year
-        check_date = date(check_date.year - 1, check_date.month, check_date.day)
+    if check_date > today:
+        # walk back to the latest past year, month/day might be later in the year than today
+        years_back = (check_date.year - today.year +
+                      ((check_date.month, check_date.day) > (today.month, today.day)))
+        check_date = check_date.replace(year=check_date.year - years_back)
     return check_date
 
 
+def _template_parse_table(template_name):
+    """(regex, stream) pairs that can match the template name, in the order to try them"""
+    if template_name.startswith('miq-'):
+        # miq-<release>-... or miq-stable-<release>-..., only that release can match
+        tokens = template_name.split('-', 3)
+        release = tokens[2] if tokens[1] == 'stable' and len(tokens) > 2 else tokens[1]
+        if release in constants.TEMPLATE_RELEASE_TABLES:
+            return constants.TEMPLATE_RELEASE_TABLES[release]
+    for prefix, parse_table in constants.TEMPLATE_PREFIX_TABLES:
+        if template_name.startswith(prefix):
+            return parse_table
+    return constants.TEMPLATE_PARSE_TABLE
+
+
+# shared by all TemplateName lookups, the session reuses connections to the build servers
+_session = requests.Session()
+
+# version files and build listings are matched as served, without decoding the whole body
+_version_file_re = re.compile(constants.VERSION_FORMAT_DOWNSTREAM.encode('ascii'))
+_image_link_re = re.compile(constants.BUILD_IMAGE_LINK, re.IGNORECASE)
+_image_name_re = re.compile(constants.BUILD_IMAGE_FORMAT_UPSTREAM)
+
+
 @attr.s
 class TemplateName(object):
     """Generate a template name from given link, using build timestamp
@@ -279,11 +395,13 @@ class TemplateName(object):
     SHA = 'SHA256SUM'
     CFME_ID = 'cfme'
     MIQ_ID = 'miq'
-    build_url = attr.ib()  # URL to the build folder with ova/vhd/qc2/etc images
+    # URL to the build folder with ova/vhd/qc2/etc images
+    build_url = attr.ib(converter=attr.converters.optional(str),
+                        validator=attr.validators.instance_of(str))
     # specific image URL, when set the template name will include build type info, like paravirtual
     image_url = attr.ib(default=None)
 
-    @property
+    @cached_property
     def build_version(self):
         """Version string from version file in build folder (cfme)
         release name and build number from an image file (MIQ)
@@ -296,31 +414,24 @@ class TemplateName(object):
         Returns:
             String 5-digit version number or release name for MIQ
         """
-        v = requests.get('/'.join([self.build_url, 'version']))
+        v = _session.get('/'.join([self.build_url, 'version']))
         if v.ok:
             # split and reform version string to be explicit and verbose+
-            match = re.search(constants.VERSION_FORMAT_DOWNSTREAM, v.content.decode('utf-8'))
+            match = _version_file_re.search(v.content)
             if match:
-                return '.'.join([match.group('major'),
-                                 match.group('minor'),
-                                 match.group('patch'),
-                                 match.group('build')])
+                return b'.'.join(match.group('major', 'minor', 'patch', 'build')).decode('ascii')
             else:
                 raise ValueError(
                     f'Unable to match version string in {self.build_url}/version: {v.content}'
                 )
         else:
-            build_dir = requests.get(self.build_url)
-            link_parser = html.fromstring(build_dir.content)
+            build_dir = _session.get(self.build_url)
             # Find image file links, use first one to pattern match name
-            # iterlinks returns tuple of (element, attribute, link, position)
-            images = [l
-                      for _, a, l, _ in link_parser.iterlinks()
-                      if a == 'href' and l.endswith('.ova') or l.endswith('.vhd')]
-            if images:
+            image_link = _image_link_re.search(build_dir.content)
+            if image_link:
                 # pull release and its possible number (with -) from image string
-                image = images[0]
-                match = re.search(constants.BUILD_IMAGE_FORMAT_UPSTREAM, str(image))
+                image = image_link.group('image').decode('utf-8')
+                match = _image_name_re.search(image)
                 if match:
                     # if its a master image, version is 'nightly', otherwise use release+number
                     return f'{match.group("release")}{match.group("number") or ""}'
@@ -329,18 +440,23 @@ class TemplateName(object):
             else:
                 raise ValueError(f'No image of expected type found in {self.build_url}')
 
-    @property
+    @cached_property
     def build_date(self):
         """Get a build date from the SHA256SUM"""
-        r = requests.get('/'.join([self.build_url, self.SHA]))
+        # only the Last-Modified header is needed, skip downloading the file
+        url = '/'.join([self.build_url, self.SHA])
+        r = _session.head(url, allow_redirects=True)
+        if r.status_code in (requests.codes.method_not_allowed, requests.codes.not_implemented):
+            # the server doesn't answer HEAD, fall back to a GET without reading its body
+            r = _session.get(url, stream=True)
+            r.close()
         if r.ok:
-            timestamp = datetime.strptime(r.headers.get('Last-Modified'),
-                                          "%a, %d %b %Y %H:%M:%S %Z")
-            return timestamp.strftime('%Y%m%d')
+            timestamp = parsedate_to_datetime(r.headers.get('Last-Modified'))
+            return f'{timestamp.year:04d}{timestamp.month:02d}{timestamp.day:02d}'
         else:
             raise ValueError(f'{self.SHA} file not found in {self.build_url}')
 
-    @property
+    @cached_property
     def build_type(self):
         """Get a specific template type from the image URL
         Used for things like vpshere where there is separate paravirtual image
@@ -356,7 +472,7 @@ class TemplateName(object):
         else:
             return self.image_url.split('.')[-1]  # file type
 
-    @property
+    @cached_property
     def template_name(self):
         """Actually construct the template name"""
         name_args = [self.CFME_ID if self.CFME_ID in self.build_url else self.MIQ_ID,
@@ -378,46 +494,48 @@ class TemplateName(object):
                   datestamp with be a :py:class:`datetime.date <python:datetime.date>`, or None if
                   a date can't be derived from the template name
             """
-        for stream_tuple in constants.version_stream_product_mapping.values():
-            for regex in stream_tuple.template_regex:
-                matches = re.match(regex, template_name)
-                if matches:
-                    groups = matches.groupdict()
-                    # hilarity may ensue if this code is run right before the new year
-                    today = date.today()
-                    year = int(groups.get('year', today.year) or today.year)
-                    month, day = int(groups['month']), int(groups['day'])
-                    version = groups.get('ver', '')
-                    if (
-                        '.' not in version  # the version in the template wasn't dotted
-                        and 'downstream' in stream_tuple.stream  # don't try to parse upstream
-                        and len(version) > 3
-                    ):  # sprout templates only have stream
-                        # old template name format with no dots
-                        if version.startswith('51'):
-                            version = f'{version[0]}.{version[1:3]}.{version[3]}.{version[4:]}'
-                        else:
-                            version = f'{version[0]}.{version[1]}.{version[2]}.{version[3:]}'
-
-                    # strip - in case regex includes them, replace empty string with None
-                    temp_type = groups.get('type') or None
-                    # validate the template date by turning into a date obj
-                    try:
-                        # year, month, day might have been parsed incorrectly with loose regex
-                        template_date = datecheck(date(year, month, day))
-                    except ValueError:
-                        continue
-
-                    return constants.TemplateInfo(
-                        stream_tuple.stream,
-                        template_date,
-                        True,
-                        version,
-                        temp_type
-                    )
-        for group_name, regex in constants.generic_matchers:
-            matches = re.match(regex, template_name)
+        # the result depends on the current date, which is part of the cache key
+        return cls._parse_template(template_name, date.today())
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def _parse_template(cls, template_name, today):
+        """Cached :py:meth:`parse_template`, dates in the result are checked against today"""
+        for regex, stream in _template_parse_table(template_name):
+            matches = regex.match(template_name)
             if matches:
+                groups = matches.groupdict()
+                year = int(groups.get('year', today.year) or today.year)
+                month, day = int(groups['month']), int(groups['day'])
+                version = groups.get('ver', '')
+                if (
+                    '.' not in version  # the version in the template wasn't dotted
+                    and 'downstream' in stream  # don't try to parse upstream
+                    and len(version) > 3
+                ):  # sprout templates only have stream
+                    # old template name format with no dots, 5.1x has a two digit minor
+                    patch = 3 if version.startswith('51') else 2
+                    version = (f'{version[0]}.{version[1:patch]}.'
+                               f'{version[patch]}.{version[patch + 1:]}')
+
+                # strip - in case regex includes them, replace empty string with None
+                temp_type = groups.get('type') or None
+                # validate the template date by turning into a date obj
+                try:
+                    # year, month, day might have been parsed incorrectly with loose regex
+                    template_date = datecheck(date(year, month, day), today)
+                except ValueError:
+                    continue
+
+                return constants.TemplateInfo(
+                    stream,
+                    template_date,
+                    True,
+                    version,
+                    temp_type
+                )
+        for group_name, prefixes in constants.GENERIC_PREFIXES:
+            if template_name.startswith(prefixes):
                 return constants.TemplateInfo(group_name, None, False, None, None)
         # If no match, unknown
         return constants.TemplateInfo('unknown', None, False, None, None)
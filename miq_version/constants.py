@@ -1,6 +1,7 @@
 # Constants for use in version sorting, comparisons, template naming
 # Basic data types
 
+import re
 from collections import namedtuple
 
 SPTuple = namedtuple('StreamProductTuple', ['stream', 'product_version', 'template_regex'])
@@ -41,50 +42,73 @@ FORMATS_UPSTREAM = {
 VERSION_FORMAT_DOWNSTREAM = (r'^(?P<major>\d)\.(?P<minor>\d{1,2})\.'
                              r'(?P<patch>\d{1,2})\.(?P<build>\d{1,2})')
 
+# image file link in a build directory listing, example: href="manageiq-vsphere-jansa-1.ova"
+BUILD_IMAGE_LINK = rb'href=["\'](?P<image>[^"\']+\.(?:ova|vhd))["\']'
+
 # example: manageiq-ovirt-jansa-202005250000-bd09bd05d4.qc2
-BUILD_IMAGE_FORMAT_UPSTREAM = (r'manageiq-(?:[\w]+?)-(?P<release>[\w]+?)(?P<number>-\d)?-\d{''3,}')
+BUILD_IMAGE_FORMAT_UPSTREAM = (r'manageiq-(?:[\w]+?)-(?P<release>[\w]+?)(?P<number>-\d)?-\d{3,}')
+
+
+def _downstream_regexes(major, minor):
+    """Compiled template regexes of a downstream stream"""
+    return tuple(re.compile(regex.format(major=major, minor=minor))
+                 for regex in FORMATS_DOWNSTREAM.values())
+
+
+def _upstream_regexes(stream):
+    """Compiled template regexes of an upstream release"""
+    return tuple(re.compile(regex.format(stream=stream)) for regex in FORMATS_UPSTREAM.values())
+
 
 version_stream_product_mapping = {
-    '5.2': SPTuple('downstream-52z', '3.0',
-                   [regex.format(major='5', minor='2') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.3': SPTuple('downstream-53z', '3.1',
-                   [regex.format(major='5', minor='3') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.4': SPTuple('downstream-54z', '3.2',
-                   [regex.format(major='5', minor='4') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.5': SPTuple('downstream-55z', '4.0',
-                   [regex.format(major='5', minor='5') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.6': SPTuple('downstream-56z', '4.1',
-                   [regex.format(major='5', minor='6') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.7': SPTuple('downstream-57z', '4.2',
-                   [regex.format(major='5', minor='7') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.8': SPTuple('downstream-58z', '4.5',
-                   [regex.format(major='5', minor='8') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.9': SPTuple('downstream-59z', '4.6',
-                   [regex.format(major='5', minor='9') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.10': SPTuple('downstream-510z', '4.7',
-                   [regex.format(major='5', minor='10') for regex in FORMATS_DOWNSTREAM.values()]),
-    '5.11': SPTuple('downstream-511z', '5.0',
-                    [regex.format(major='5', minor='11') for regex in FORMATS_DOWNSTREAM.values()]),
-    'euwe': SPTuple('upstream-euwe', 'euwe',
-                    [regex.format(stream='euwe') for regex in FORMATS_UPSTREAM.values()]),
-    'fine': SPTuple('upstream-fine', 'fine',
-                    [regex.format(stream='fine') for regex in FORMATS_UPSTREAM.values()]),
-    'gaprindashvili': SPTuple(
-        'upstream-gaprindashvili',
-        'gaprindashvili',
-        [regex.format(stream='gaprindashvili') for regex in FORMATS_UPSTREAM.values()]
-    ),
-    'hammer': SPTuple('upstream-hammer', 'hammer',
-                    [regex.format(stream='hammer') for regex in FORMATS_UPSTREAM.values()]),
-    'ivanchuk': SPTuple('upstream-ivanchuk', 'ivanchuk',
-                    [regex.format(stream='ivanchuk') for regex in FORMATS_UPSTREAM.values()]),
-    'jansa': SPTuple('upstream-jansa', 'jansa',
-                    [regex.format(stream='jansa') for regex in FORMATS_UPSTREAM.values()]),
-    'master': SPTuple('upstream', 'master',
-                    [r'miq-nightly-(?P<ver>(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}))',
-                     r'miq-(?P<ver>(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}))',
-                     r'^s(-|_)(appl|tpl)(-|_)upstream(-|_)(stable(-|_))?'
-                     r'(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})'])
+    '5.2': SPTuple('downstream-52z', '3.0', _downstream_regexes('5', '2')),
+    '5.3': SPTuple('downstream-53z', '3.1', _downstream_regexes('5', '3')),
+    '5.4': SPTuple('downstream-54z', '3.2', _downstream_regexes('5', '4')),
+    '5.5': SPTuple('downstream-55z', '4.0', _downstream_regexes('5', '5')),
+    '5.6': SPTuple('downstream-56z', '4.1', _downstream_regexes('5', '6')),
+    '5.7': SPTuple('downstream-57z', '4.2', _downstream_regexes('5', '7')),
+    '5.8': SPTuple('downstream-58z', '4.5', _downstream_regexes('5', '8')),
+    '5.9': SPTuple('downstream-59z', '4.6', _downstream_regexes('5', '9')),
+    '5.10': SPTuple('downstream-510z', '4.7', _downstream_regexes('5', '10')),
+    '5.11': SPTuple('downstream-511z', '5.0', _downstream_regexes('5', '11')),
+    'euwe': SPTuple('upstream-euwe', 'euwe', _upstream_regexes('euwe')),
+    'fine': SPTuple('upstream-fine', 'fine', _upstream_regexes('fine')),
+    'gaprindashvili': SPTuple('upstream-gaprindashvili', 'gaprindashvili',
+                              _upstream_regexes('gaprindashvili')),
+    'hammer': SPTuple('upstream-hammer', 'hammer', _upstream_regexes('hammer')),
+    'ivanchuk': SPTuple('upstream-ivanchuk', 'ivanchuk', _upstream_regexes('ivanchuk')),
+    'jansa': SPTuple('upstream-jansa', 'jansa', _upstream_regexes('jansa')),
+    'master': SPTuple('upstream', 'master', tuple(map(re.compile, [
+        r'miq-nightly-(?P<ver>(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}))',
+        r'miq-(?P<ver>(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}))',
+        r'^s(-|_)(appl|tpl)(-|_)upstream(-|_)(stable(-|_))?'
+        r'(?P<year>\d{2})(?P<month>\d{2})(?P<day>\d{2})'])))
+}
+
+
+def _parse_table(stream_tuples):
+    """Flat (template regex, stream) pairs of the given streams, in the given order"""
+    return tuple((regex, spt.stream) for spt in stream_tuples for regex in spt.template_regex)
+
+
+# newest streams first, most templates in use are from the latest releases
+_newest_first = list(reversed(list(version_stream_product_mapping.values())))
+# template regexes that can match a name with the given prefix, parse_template falls back to
+# TEMPLATE_PARSE_TABLE for any other name
+TEMPLATE_PARSE_TABLE = _parse_table(_newest_first)
+_downstream = _parse_table(spt for spt in _newest_first if 'downstream' in spt.stream)
+_upstream = _parse_table(spt for spt in _newest_first if 'downstream' not in spt.stream)
+TEMPLATE_PREFIX_TABLES = (
+    ('cfme-', _downstream),
+    ('docker-', _downstream),
+    ('miq-', _upstream),
+    ('s_', TEMPLATE_PARSE_TABLE),
+    ('s-', TEMPLATE_PARSE_TABLE),
+)
+# upstream template regexes by the release name following miq-[stable-] in the template name
+TEMPLATE_RELEASE_TABLES = {
+    ('nightly' if name == 'master' else name): _parse_table([spt])
+    for name, spt in version_stream_product_mapping.items() if 'downstream' not in spt.stream
 }
 
 UPSTREAM_DOWNSTREAM_MAPPING = {
@@ -107,8 +131,10 @@ SORTED_UPSTREAM_RELEASES = sorted(
     reverse=True
 )
 LATEST_UP_STREAM = SORTED_UPSTREAM_RELEASES[0]
+# finds an upstream release name anywhere in a version string
+UPSTREAM_SERIES_RE = re.compile('|'.join(map(re.escape, SORTED_UPSTREAM_RELEASES)))
 
-# maps some service templates
+# maps some service templates, by anchored literal template name prefixes
 generic_matchers = (
     ('sprout', r'^s_tpl'),
     ('sprout', r'^s-tpl'),
@@ -117,3 +143,15 @@ generic_matchers = (
     ('sprout', r'^sprout_template'),
     ('rhevm-internal', r'^raw'),
 )
+
+
+def _generic_prefixes(matchers):
+    """Group the anchored literal regexes of generic_matchers into (name, prefixes) pairs"""
+    prefixes = {}
+    for group_name, regex in matchers:
+        prefixes.setdefault(group_name, []).append(regex.lstrip('^'))
+    return tuple((group_name, tuple(group)) for group_name, group in prefixes.items())
+
+
+# generic_matchers as name prefixes, for parse_template to check with str.startswith
+GENERIC_PREFIXES = _generic_prefixes(generic_matchers)
@@ -0,0 +1,7 @@
+import pytest
+from datetime import date
+
+
+@pytest.fixture(scope='session')
+def today():
+    return date.today()
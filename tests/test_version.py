@@ -1,100 +1,109 @@
-# -*- coding: utf-8 -*-
+import copy
+import pickle
 import pytest
+import weakref
 from datetime import date
 
-from deepdiff import DeepDiff
-
-from miq_version import Version, TemplateName, datecheck
+from miq_version import Version, TemplateName, datecheck, get_version
 from miq_version.constants import TemplateInfo
 
-TODAY = date.today()
-
-version_list = [
-    Version('5.7.0.0'),
-    Version('5.7.0.11-rc1'),
-    Version('5.7.0.5-alpha2'),
-    Version('5.7.0.17-nightly'),
-    Version('5.7.0.6-alpha3'),
-    Version('5.7.0.12-rc2'),
-    Version('5.7.0.1'),
-    Version('5.7.0.6'),
-    Version('5.7.0.5'),
-    Version('5.7.0.4'),
-    Version('5.7.0.9'),
-    Version('5.7.0.2'),
-    Version('5.7.0.10-beta3'),
-    Version('5.7.0.13-rc3'),
-    Version('5.7.0.3'),
-    Version('5.7.0.7-beta1'),
-    Version('5.7.1.3'),
-    Version('5.7.1.0'),
-    Version('5.7.1.1'),
-    Version('5.7.4.3'),
-    Version('5.7.4.2'),
-    Version('5.7.4.1'),
-    Version('5.7.4.0'),
-    Version('5.7.2.1'),
-    Version('5.7.2.0'),
-    Version('5.7.3.2'),
-    Version('5.7.1.2'),
-    Version('5.7.0.17'),
-    Version('5.7.0.16'),
-    Version('5.7.0.14'),
-    Version('5.7.0.13'),
-    Version('5.7.0.11'),
-    Version('5.7.0.10'),
-    Version('5.7.0.14-rc4'),
-    Version('5.7.3.1'),
-    Version('5.7.0.9-beta2.1'),
-    Version('5.7.0.7'),
-    Version('5.7.0.4-alpha1'),
-    Version('5.7.3.0'),
-    Version('5.7.0.12')
+version_strings = [
+    '5.7.0.0',
+    '5.7.0.11-rc1',
+    '5.7.0.5-alpha2',
+    '5.7.0.17-nightly',
+    '5.7.0.6-alpha3',
+    '5.7.0.12-rc2',
+    '5.7.0.1',
+    '5.7.0.6',
+    '5.7.0.5',
+    '5.7.0.4',
+    '5.7.0.9',
+    '5.7.0.2',
+    '5.7.0.10-beta3',
+    '5.7.0.13-rc3',
+    '5.7.0.3',
+    '5.7.0.7-beta1',
+    '5.7.1.3',
+    '5.7.1.0',
+    '5.7.1.1',
+    '5.7.4.3',
+    '5.7.4.2',
+    '5.7.4.1',
+    '5.7.4.0',
+    '5.7.2.1',
+    '5.7.2.0',
+    '5.7.3.2',
+    '5.7.1.2',
+    '5.7.0.17',
+    '5.7.0.16',
+    '5.7.0.14',
+    '5.7.0.13',
+    '5.7.0.11',
+    '5.7.0.10',
+    '5.7.0.14-rc4',
+    '5.7.3.1',
+    '5.7.0.9-beta2.1',
+    '5.7.0.7',
+    '5.7.0.4-alpha1',
+    '5.7.3.0',
+    '5.7.0.12'
 ]
 
-reverse_sorted_version = [
-    Version('5.7.4.3'),
-    Version('5.7.4.2'),
-    Version('5.7.4.1'),
-    Version('5.7.4.0'),
-    Version('5.7.3.2'),
-    Version('5.7.3.1'),
-    Version('5.7.3.0'),
-    Version('5.7.2.1'),
-    Version('5.7.2.0'),
-    Version('5.7.1.3'),
-    Version('5.7.1.2'),
-    Version('5.7.1.1'),
-    Version('5.7.1.0'),
-    Version('5.7.0.17'),
-    Version('5.7.0.17-nightly'),
-    Version('5.7.0.16'),
-    Version('5.7.0.14'),
-    Version('5.7.0.14-rc4'),
-    Version('5.7.0.13'),
-    Version('5.7.0.13-rc3'),
-    Version('5.7.0.12'),
-    Version('5.7.0.12-rc2'),
-    Version('5.7.0.11'),
-    Version('5.7.0.11-rc1'),
-    Version('5.7.0.10'),
-    Version('5.7.0.10-beta3'),
-    Version('5.7.0.9'),
-    Version('5.7.0.9-beta2.1'),
-    Version('5.7.0.7'),
-    Version('5.7.0.7-beta1'),
-    Version('5.7.0.6'),
-    Version('5.7.0.6-alpha3'),
-    Version('5.7.0.5'),
-    Version('5.7.0.5-alpha2'),
-    Version('5.7.0.4'),
-    Version('5.7.0.4-alpha1'),
-    Version('5.7.0.3'),
-    Version('5.7.0.2'),
-    Version('5.7.0.1'),
-    Version('5.7.0.0')
+reverse_sorted_strings = [
+    '5.7.4.3',
+    '5.7.4.2',
+    '5.7.4.1',
+    '5.7.4.0',
+    '5.7.3.2',
+    '5.7.3.1',
+    '5.7.3.0',
+    '5.7.2.1',
+    '5.7.2.0',
+    '5.7.1.3',
+    '5.7.1.2',
+    '5.7.1.1',
+    '5.7.1.0',
+    '5.7.0.17',
+    '5.7.0.17-nightly',
+    '5.7.0.16',
+    '5.7.0.14',
+    '5.7.0.14-rc4',
+    '5.7.0.13',
+    '5.7.0.13-rc3',
+    '5.7.0.12',
+    '5.7.0.12-rc2',
+    '5.7.0.11',
+    '5.7.0.11-rc1',
+    '5.7.0.10',
+    '5.7.0.10-beta3',
+    '5.7.0.9',
+    '5.7.0.9-beta2.1',
+    '5.7.0.7',
+    '5.7.0.7-beta1',
+    '5.7.0.6',
+    '5.7.0.6-alpha3',
+    '5.7.0.5',
+    '5.7.0.5-alpha2',
+    '5.7.0.4',
+    '5.7.0.4-alpha1',
+    '5.7.0.3',
+    '5.7.0.2',
+    '5.7.0.1',
+    '5.7.0.0'
 ]
 
+
+@pytest.fixture(scope='session')
+def version_list():
+    return [Version(v) for v in version_strings]
+
+
+@pytest.fixture(scope='session')
+def reverse_sorted_version():
+    return [Version(v) for v in reverse_sorted_strings]
+
+
 GT = '>'
 LT = '<'
 EQ = '=='
@@ -125,7 +134,11 @@ NE = '!='
     ('5.12', LT, 'master'),
     ('5.10', LT, 'master'),
     ('5.10', NE, 'hammer'),
-    ('5.11', NE, 'ivanchuk')
+    ('5.11', NE, 'ivanchuk'),
+    ('hammer-jansa', EQ, 'jansa'),
+    ('5.10-hammer-to-jansa', EQ, 'jansa'),
+    ('hammer', LT, '5.10'),
+    ('hammer', GT, '5.9.4.1'),
 ])
 def test_version(v1, op, v2):
     v1 = Version(v1)
@@ -147,10 +160,29 @@ def test_version(v1, op, v2):
         assert v1 != v2
 
 
-def test_version_list():
+def test_version_list(version_list, reverse_sorted_version):
     assert sorted(version_list, reverse=True) == reverse_sorted_version
 
 
+def test_get_version_cached():
+    assert get_version('5.10.0.1') is get_version('5.10.0.1')
+    assert get_version('5.10.0.1') == Version('5.10.0.1')
+    assert get_version('master') is Version.latest()
+
+
+def test_get_version_suffix_immutable():
+    version = get_version('5.10.0.1-rc1')
+    assert version.suffix == ('rc1',)
+    with pytest.raises(AttributeError):
+        version.suffix.append('beta')
+    assert get_version('5.10.0.1-rc1') < '5.10.0.1'
+
+
+def test_version_weakref():
+    version = Version('5.10')
+    assert weakref.ref(version)() is version
+
+
 @pytest.mark.parametrize(('version', 'series', 'stream'), [
     ('master', 'master', 'upstream'),
     ('euwe', 'euwe', 'upstream-euwe'),
@@ -159,6 +191,7 @@ def test_version_list():
     ('hammer', 'hammer', 'upstream-hammer'),
     ('ivanchuk', 'ivanchuk', 'upstream-ivanchuk'),
     ('jansa', 'jansa', 'upstream-jansa'),
+    ('5.10-hammer-to-jansa', 'jansa', 'upstream-jansa'),
     ('5.10.0.0', '5.10', 'downstream-510z'),
     ('5.11.0.0', '5.11', 'downstream-511z'),
 ])
@@ -167,31 +200,20 @@ def test_version_series_stream(version, series, stream):
     assert Version(version).stream() == stream
 
 
+@pytest.mark.parametrize('copier', [copy.copy, copy.deepcopy,
+                                    lambda v: pickle.loads(pickle.dumps(v))])
+def test_version_copy(copier):
+    version = Version('5.10.1')
+    copied = copier(version)
+    assert copied == version
+    assert hash(copied) == hash(version)
+    assert copied.stream() == 'downstream-510z'
+    assert copied.product_version() == '4.7'
+
+
 # namedtuple('TemplateInfo', ['group_name', 'datestamp', 'stream', 'version', 'type'])
 @pytest.mark.parametrize(
     ('tmp_name', 'info_tuple'), [
-        ('cfme-51006-07252250',  # older format
-         TemplateInfo(
-             'downstream-510z',
-             # pick the year dynamically based on TODAY
-             date(TODAY.year if (TODAY.month > 7 or (TODAY.month == 7 and TODAY.day >= 25))
-                  else (TODAY.year - 1),
-                  7, 25),
-             True,
-             '5.10.0.6',
-             None)
-         ),
-        ('cfme-59410-04132250',  # older format, might break eventually because of year not present
-         TemplateInfo(
-             'downstream-59z',
-             # pick the year dynamically based on TODAY
-             date(TODAY.year if (TODAY.month > 4 or (TODAY.month == 4 and TODAY.day >= 13))
-                  else (TODAY.year - 1),
-                  4, 13),
-             True,
-             '5.9.4.10',
-             None)
-         ),
         ('miq-nightly-20180531',
          TemplateInfo('upstream', date(2018, 5, 31), True, '20180531', None)),
         ('miq-euwe-20161028',
@@ -236,14 +258,24 @@ def test_version_series_stream(version, series, stream):
          TemplateInfo('downstream-510z', date(2018, 6, 21), True, '510', None))],
 )
 def test_template_parsing(tmp_name, info_tuple):
-    parsed = TemplateName.parse_template(tmp_name)
-    print('template name: {}'.format(tmp_name))
-    print('Parsed template: {}'.format(parsed))
-    print('expected: {}'.format(info_tuple))
-    diff = DeepDiff(parsed, info_tuple,
-                    verbose_level=0,  # If any higher, will flag string vs unicode
-                    ignore_order=False)
-    assert diff == {}
+    assert TemplateName.parse_template(tmp_name) == info_tuple
+
+
+@pytest.mark.parametrize(
+    ('tmp_name', 'stream', 'version', 'month', 'day'), [
+        ('cfme-51006-07252250', 'downstream-510z', '5.10.0.6', 7, 25),  # older format
+        # older format, might break eventually because of year not present
+        ('cfme-59410-04132250', 'downstream-59z', '5.9.4.10', 4, 13)])
+def test_template_parsing_no_year(today, tmp_name, stream, version, month, day):
+    # the year is the latest one in which the month/day isn't in the future
+    year = today.year if (month, day) <= (today.month, today.day) else today.year - 1
+    assert (TemplateName.parse_template(tmp_name) ==
+            TemplateInfo(stream, date(year, month, day), True, version, None))
+
+
+def test_template_parsing_cached():
+    parsed = TemplateName.parse_template('cfme-5.9.3.4-20180531')
+    assert TemplateName.parse_template('cfme-5.9.3.4-20180531') is parsed
 
 
 @pytest.mark.parametrize(
@@ -261,22 +293,98 @@ def test_template_build_type(image_url, expected_type):
     assert t.build_type == expected_type
 
 
+class FakeResponse(object):
+    def __init__(self, content=b'', headers=None, status_code=200):
+        self.content = content
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def close(self):
+        pass
+
+
+def test_template_name_no_build_url():
+    with pytest.raises(TypeError):
+        TemplateName(build_url=None)
+
+
+def test_template_name_cached(monkeypatch):
+    build_url = 'http://fake.example.com/builds/cfme/5.11/stable'
+    responses = {
+        ('GET', f'{build_url}/version'): FakeResponse(b'5.11.0.25\n'),
+        ('HEAD', f'{build_url}/SHA256SUM'): FakeResponse(
+            headers={'Last-Modified': 'Tue, 01 Oct 2019 10:00:00 GMT'}),
+    }
+    requested = []
+
+    def fake_request(method):
+        def request(url, **kwargs):
+            requested.append((method, url))
+            return responses[(method, url)]
+        return request
+    monkeypatch.setattr('miq_version._session.get', fake_request('GET'))
+    monkeypatch.setattr('miq_version._session.head', fake_request('HEAD'))
+
+    t = TemplateName(build_url=build_url)
+    assert t.template_name == 'cfme-5.11.0.25-20191001'
+    assert t.template_name == 'cfme-5.11.0.25-20191001'
+    assert sorted(requested) == sorted(responses)
+
+
+def test_template_name_build_date_without_head(monkeypatch):
+    build_url = 'http://fake.example.com/builds/cfme/5.11/stable'
+    sha = FakeResponse(headers={'Last-Modified': 'Tue, 01 Oct 2019 10:00:00 GMT'})
+    monkeypatch.setattr('miq_version._session.head',
+                        lambda url, **kwargs: FakeResponse(status_code=405))
+    monkeypatch.setattr('miq_version._session.get', lambda url, **kwargs: sha)
+
+    assert TemplateName(build_url=build_url).build_date == '20191001'
+
+
+def test_template_name_build_date_missing(monkeypatch):
+    build_url = 'http://fake.example.com/builds/cfme/5.11/stable'
+    monkeypatch.setattr('miq_version._session.head',
+                        lambda url, **kwargs: FakeResponse(status_code=404))
+    monkeypatch.setattr('miq_version._session.get', lambda url, **kwargs: pytest.fail('GET sent'))
+
+    with pytest.raises(ValueError):
+        TemplateName(build_url=build_url).build_date
+
+
+def test_template_name_upstream_image(monkeypatch):
+    build_url = 'http://fake.example.com/builds/manageiq/jansa/stable'
+    listing = (b'<html><body><a href="SHA256SUM">SHA256SUM</a>\n'
+               b'<a href="manageiq-openstack-jansa-1-202005250000-bd09bd05d4.qc2">qc2</a>\n'
+               b"<a href='manageiq-vsphere-jansa-1-202005250000-bd09bd05d4.ova'>ova</a>\n"
+               b'</body></html>')
+    responses = {
+        f'{build_url}/version': FakeResponse(status_code=404),
+        build_url: FakeResponse(listing),
+    }
+    monkeypatch.setattr('miq_version._session.get', lambda url, **kwargs: responses[url])
+
+    assert TemplateName(build_url=build_url).build_version == 'jansa-1'
+
+
 @pytest.mark.parametrize(
-    ('test_date',
-     'expected_date'),
-    [(date(2018, 1, 1),
-      date(2018, 1, 1)),
-     (date(2000, TODAY.month, TODAY.day),
-      date(2000, TODAY.month, TODAY.day)),  # past, no modify
-     (date(1999, TODAY.month, TODAY.day),
-      date(TODAY.year, TODAY.month, TODAY.day)),  # past, modified
-     (date(16, TODAY.month, TODAY.day),
-      date(2016, TODAY.month, TODAY.day)),  # short year
-     (date(30, TODAY.month, TODAY.day),
-      date(TODAY.year, TODAY.month, TODAY.day)),  # short year, future
-     (date(1130, TODAY.month, TODAY.day),
-      date(TODAY.year, TODAY.month, TODAY.day)),  # bad parse
-     (date(TODAY.year + 10, TODAY.month, TODAY.day),
-      date(TODAY.year, TODAY.month, TODAY.day))])
-def test_datecheck(test_date, expected_date):
-    assert expected_date == datecheck(test_date)
+    ('year', 'expected_year'),
+    [(2018, 2018),
+     (2000, 2000),  # past, no modify
+     (16, 2016)])  # short year
+def test_datecheck(today, year, expected_year):
+    assert today.replace(year=expected_year) == datecheck(today.replace(year=year), today)
+
+
+@pytest.mark.parametrize(
+    'year',
+    [1999,  # past, modified
+     30,  # short year, future
+     1130])  # bad parse
+def test_datecheck_this_year(today, year):
+    assert today == datecheck(today.replace(year=year), today)
+
+
+@pytest.mark.parametrize('year_offset', [1, 10])
+def test_datecheck_future(today, year_offset):
+    assert today == datecheck(today.replace(year=today.year + year_offset), today)